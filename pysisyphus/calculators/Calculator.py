@@ -1,3 +1,4 @@
+import asyncio
 from dataclasses import dataclass
 from enum import Enum
 import logging
@@ -36,6 +37,14 @@ class SetPlan:
             self.name = self.key
 
 
+def event_loop_running():
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
 class Calculator:
 
     conf_key = None
@@ -95,6 +104,8 @@ class Calculator:
             Force numerical Hessians.
         num_hess_kwargs : dict
             Keyword arguments for finite difference Hessian calculation.
+            With 'batch: True' displaced gradients are calculated concurrently,
+            if the calculator supports it (XTB).
         """
 
         self.logger = logging.getLogger("calculator")
@@ -213,13 +224,31 @@ class Calculator:
             "step_size": 0.005,
             # Central difference by default
             "acc": 2,
+            # Concurrent gradient calculations have to be requested explicitly
+            "batch": False,
         }
         _num_hess_kwargs.update(self.num_hess_kwargs)
+        batch = _num_hess_kwargs.pop("batch")
+
+        # Calculators that can run several gradient calculations concurrently.
+        # This is not possible from within an already running event loop, e.g.,
+        # in Jupyter, so we fall back to serial calculations there.
+        if batch and hasattr(self, "get_forces_batch") and not event_loop_running():
+
+            def batch_grad_func(coords_list):
+                all_results = self.get_forces_batch(
+                    [atoms] * len(coords_list), coords_list, **prepare_kwargs
+                )
+                return [-results["forces"] for results in all_results]
+
+        else:
+            batch_grad_func = None
 
         fd_hessian = finite_difference_hessian(
             coords,
             grad_func,
             callback=callback,
+            batch_grad_func=batch_grad_func,
             **_num_hess_kwargs,
         )
         results["hessian"] = fd_hessian
@@ -560,17 +589,7 @@ class Calculator:
                 self.keep(path)
 
         except Exception as err:
-            print("Crashed input:")
-            print(inp)
-            backup_dir = Path(os.getcwd()) / f"crashed_{self.name}"
-            self.backup_dir = backup_dir
-            if backup_dir.exists():
-                shutil.rmtree(backup_dir)
-            shutil.copytree(path, backup_dir)
-            print(
-                f"Copied contents of\n\t'{path}'\nto\n\t'{backup_dir}'.\n"
-                "Consider checking the log files there.\n"
-            )
+            self.backup_crashed(inp, path)
             raise err
         finally:
             if (not hold) and self.clean_after:
@@ -582,6 +601,28 @@ class Calculator:
         self.last_run_path = path
         return results
 
+    def backup_crashed(self, inp, path):
+        """Copy the temporary directory of a crashed calculation.
+
+        Parameters
+        ----------
+        inp : str
+            Input of the crashed calculation.
+        path : Path
+            Temporary directory of the crashed calculation.
+        """
+        print("Crashed input:")
+        print(inp)
+        backup_dir = Path(os.getcwd()) / f"crashed_{self.name}"
+        self.backup_dir = backup_dir
+        if backup_dir.exists():
+            shutil.rmtree(backup_dir)
+        shutil.copytree(path, backup_dir)
+        print(
+            f"Copied contents of\n\t'{path}'\nto\n\t'{backup_dir}'.\n"
+            "Consider checking the log files there.\n"
+        )
+
     def run_after(self, path):
         """Meant to be extended.
 
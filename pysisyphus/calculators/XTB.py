@@ -1,10 +1,13 @@
+import asyncio
 from collections import namedtuple
-import io
 import json
 import os
+from pathlib import Path
 import re
 import shutil
-import textwrap
+import tempfile
+import warnings
+import weakref
 
 import numpy as np
 
@@ -13,11 +16,52 @@ from pysisyphus.calculators.parser import parse_turbo_gradient
 from pysisyphus.calculators.ORCA import save_orca_pc_file
 from pysisyphus.constants import BOHR2ANG, BOHRPERFS2AU
 from pysisyphus.helpers import geom_loader
-from pysisyphus.helpers_pure import file_or_str
 from pysisyphus.xyzloader import make_xyz_str
 
 
 OptResult = namedtuple("OptResult", "opt_geom opt_log")
+_ENERGY_RE = re.compile(rb"TOTAL ENERGY\s*([-\d\.]+) Eh")
+_TERM_RE = re.compile(b"finished run on")
+# Fortran-style exponents for the mdrestart file
+_E_TO_D = str.maketrans("e", "D")
+
+
+def search_tail(fn, regex, tail_size=4096):
+    """Search only the end of a file, falling back to the full file.
+
+    Returns the last match of the (bytes) regex or None."""
+    with open(fn, "rb") as handle:
+        size = handle.seek(0, os.SEEK_END)
+        handle.seek(max(0, size - tail_size))
+        mobj = None
+        for mobj in regex.finditer(handle.read()):
+            pass
+        if (mobj is None) and (size > tail_size):
+            handle.seek(0)
+            for mobj in regex.finditer(handle.read()):
+                pass
+    return mobj
+
+
+def link_or_copy(src, dst):
+    """Hardlink src to dst, falling back to a copy, e.g., across filesystems."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+
+def write_bytes_atomic(dst, data):
+    """Write bytes w/o a file object and atomically move them to dst."""
+    tmp = f"{dst}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+    finally:
+        os.close(fd)
+    os.replace(tmp, dst)
 
 
 class XTB(Calculator):
@@ -71,6 +115,9 @@ class XTB(Calculator):
         topo_update : int
             Integer controlling the update interval of the GFNFF topology update.
             If supplied, the topolgy will be recreated every N-th calculation.
+        pal : int
+            Number of OpenMP threads. For small and medium sized molecules xtb
+            is often faster with one thread, so pal=1 is recommended.
         mem : int
             Memory per core in MB.
         quiet : bool, optional
@@ -87,6 +134,10 @@ class XTB(Calculator):
         self.retry_etemp = retry_etemp
         self.restart = restart
         self.xtb_options = xtb_options
+        # Invariant part of the xcontrol file that is written for every calculation
+        self.xcontrol_static = self.format_xcontrol(
+            {"write": {"json": True}, **self.xtb_options}, sort=False
+        ).encode("utf-8")
         if self.etemp is not None:
             assert (
                 self.retry_etemp is None
@@ -96,12 +147,24 @@ class XTB(Calculator):
         self.quiet = quiet
 
         self.topo_used = 0
+        self._topo_key = None
+        self._staged_topo = None
+        self._topo_staging_dir = None
         self.xtbrestart = None
+        self._pal_envs = dict()
+        self._json_cache_key = None
+        self._json_cache = None
+        self._coord_buf = np.empty(0)
         valid_gfns = (0, 1, 2, "ff")
         assert (
             self.gfn in valid_gfns
         ), f"Invalid gfn argument. Allowed arguments are: {', '.join(valid_gfns)}!"
         self.uhf = self.mult - 1
+        if self.gfn == "ff" and self.pal > 1:
+            warnings.warn(
+                f"GFN-FF calculations rarely benefit from pal={self.pal} and may "
+                "even run slower than with pal=1!"
+            )
 
         self.inp_fn = "xtb.xyz"
         self.out_fn = "xtb.out"
@@ -111,7 +174,7 @@ class XTB(Calculator):
             "xtbopt.xyz",
             "g98.out",
             "xtb.trj",
-            # "json:xtbout.json",
+            "json:xtbout.json",
             "charges:charges",
             "xcontrol",
         )
@@ -128,6 +191,7 @@ class XTB(Calculator):
             "topo": self.parse_topo,
             "noparse": lambda path: None,
             "calc": self.parse_energy,
+            "energy": lambda path: {"energy": self.parse_energy(path)},
         }
 
         self.base_cmd = self.get_cmd()
@@ -136,39 +200,49 @@ class XTB(Calculator):
         pass
 
     def prepare_coords(self, atoms, coords):
-        coords = coords * BOHR2ANG
-        return make_xyz_str(atoms, coords.reshape((-1, 3)))
+        coords = np.ravel(coords)
+        # Convert into a reusable buffer instead of allocating a new array every time
+        if self._coord_buf.size < coords.size:
+            self._coord_buf = np.empty_like(coords, dtype=float)
+        coords_ang = np.multiply(coords, BOHR2ANG, out=self._coord_buf[: coords.size])
+        return make_xyz_str(atoms, coords_ang.reshape((-1, 3)))
 
     @staticmethod
-    def format_xcontrol(options):
-        inp = ""
-        for section, entries in sorted(options.items(), key=lambda x: x[0]):
-            inp += f"${section}\n"
-            for key, _val in sorted(entries.items(), key=lambda x: x[0]):
+    def format_xcontrol(options, sort=True):
+        """Format nested dict as xcontrol string.
+
+        Sections and keys are sorted by default. xtb doesn't depend on
+        the order, so sorting can be disabled, when the insertion order of
+        'options' is already deterministic."""
+
+        def items(dict_):
+            return sorted(dict_.items()) if sort else dict_.items()
+
+        lines = list()
+        for section, entries in items(options):
+            lines.append(f"${section}")
+            for key, _val in items(entries):
                 if isinstance(_val, bool):
                     val = "true" if _val else "false"
                 else:
                     val = _val
-                inp += f"    {key}={val}\n"
-            inp += "$end\n"
+                lines.append(f"    {key}={val}")
+            lines.append("$end")
 
-        return textwrap.dedent(inp.strip())
+        return "\n".join(lines)
 
     def prepare_input(self, atoms, coords, calc_type, point_charges=None):
         path = self.prepare_path(use_in_run=True)
 
-        xcontrol = {"write": {"json": True}}
-
+        xcontrol = self.xcontrol_static
         if point_charges is not None:
             pc_fn = self.make_fn("pointcharges_inp.pc")
             save_orca_pc_file(point_charges, pc_fn, hardness=99)
-            xcontrol["embedding"] = {"input": pc_fn, "interface": "orca"}
-
-        xcontrol.update(self.xtb_options)
-
-        xcontrol_str = self.format_xcontrol(xcontrol)
-        with open(path / "xcontrol", "w") as handle:
-            handle.write(xcontrol_str)
+            # An embedding section in xtb_options takes precedence
+            if "embedding" not in self.xtb_options:
+                embedding = {"embedding": {"input": pc_fn, "interface": "orca"}}
+                xcontrol += b"\n" + self.format_xcontrol(embedding).encode("utf-8")
+        write_bytes_atomic(path / "xcontrol", xcontrol)
 
         # Check if the topology has to be recreated/updated
         if (
@@ -180,46 +254,121 @@ class XTB(Calculator):
             self.topo = results["topo"]
             self.log(f"Updated topology! Saved to '{self.topo}'.")
         if self.topo:
-            shutil.copy(self.topo, path / "gfnff_topo")
+            self.link_topo(path)
             self.log(f"Using toplogy given in {self.topo}.")
             self.topo_used += 1
         if self.xtbrestart is not None:
+            # xtb overwrites xtbrestart in place, so it must not be linked.
             shutil.copy(self.xtbrestart, path / "xtbrestart")
             self.log(f"Using xtbrestart given in {self.xtbrestart}.")
 
+    def link_topo(self, path):
+        """Provide the GFN-FF topology in path, avoiding copies where possible.
+
+        The topology is only read by xtb, so a hardlink is sufficient. When it
+        can't be linked, e.g., because it resides on a different filesystem than
+        the scratch directories, it is copied once into a staging directory next
+        to them. Later calculations link this copy, as long as the topology file
+        stays unchanged."""
+        stat = os.stat(self.topo)
+        topo_key = (str(self.topo), stat.st_mtime_ns, stat.st_size)
+        dst = path / "gfnff_topo"
+        # Only (re-)stage new or modified topologies
+        if topo_key != self._topo_key:
+            try:
+                os.link(self.topo, dst)
+                self._staged_topo = self.topo
+                self._topo_key = topo_key
+                return
+            except OSError:
+                pass
+
+            if self._topo_staging_dir is None:
+                self._topo_staging_dir = Path(
+                    tempfile.mkdtemp(prefix=f"{self.name}_topo_")
+                )
+                weakref.finalize(
+                    self, shutil.rmtree, self._topo_staging_dir, ignore_errors=True
+                )
+            staged_topo = self._topo_staging_dir / "gfnff_topo"
+            # Don't overwrite the old staged topology in place, as it may still
+            # be linked into other directories.
+            if staged_topo.exists():
+                staged_topo.unlink()
+            shutil.copy(self.topo, staged_topo)
+            self._staged_topo = staged_topo
+            self._topo_key = topo_key
+        # Falls back to copying from the staged topology, e.g., on filesystems
+        # w/o hardlink support.
+        link_or_copy(self._staged_topo, dst)
+
     def prepare_add_args(self, xcontrol=None):
-        add_args = (
-            f"--input xcontrol --chrg {self.charge} --uhf {self.uhf} "
-            f"--acc {self.acc} --iterations {self.iterations}".split()
-        )
+        add_args = [
+            "--input",
+            "xcontrol",
+            "--chrg",
+            str(self.charge),
+            "--uhf",
+            str(self.uhf),
+            "--acc",
+            str(self.acc),
+            "--iterations",
+            str(self.iterations),
+        ]
         if self.etemp:
-            etemp = f"--etemp {self.etemp}".split()
-            add_args = add_args + etemp
+            add_args.extend(("--etemp", str(self.etemp)))
 
         # Use solvent model if specified
         if self.gbsa:
-            gbsa = f"--gbsa {self.gbsa}".split()
-            add_args = add_args + gbsa
+            add_args.extend(("--gbsa", self.gbsa))
         elif self.alpb:
-            alpb = f"--alpb {self.alpb}".split()
-            add_args = add_args + alpb
+            add_args.extend(("--alpb", self.alpb))
         # Select parametrization
-        gfn = ["--gfnff"] if self.gfn == "ff" else f"--gfn {self.gfn}".split()
-        add_args = add_args + gfn
+        if self.gfn == "ff":
+            add_args.append("--gfnff")
+        else:
+            add_args.extend(("--gfn", str(self.gfn)))
         return add_args
 
-    def get_pal_env(self):
-        env_copy = os.environ.copy()
-        env_copy["OMP_NUM_THREADS"] = str(self.pal)
-        env_copy["MKL_NUM_THREADS"] = str(self.pal)
-        # Per thread
-        env_copy["OMP_STACKSIZE"] = f"{self.mem}M"
-
-        return env_copy
-
-    def get_energy(self, atoms, coords, **prepare_kwargs):
-        results = self.get_forces(atoms, coords, **prepare_kwargs)
-        del results["forces"]
+    def get_pal_env(self, pal=None):
+        if pal is None:
+            pal = self.pal
+        # pal may be changed from outside, e.g., in ChainOfStates, so environments
+        # are cached per combination of pal and mem.
+        pal_key = (pal, self.mem)
+        if pal_key not in self._pal_envs:
+            env_copy = os.environ.copy()
+            # Explicitly restrict all (nested) OpenMP levels to one thread for
+            # serial calculations. Otherwise some xtb builds still spawn threads.
+            omp_threads = "1,1" if pal == 1 else str(pal)
+            env_copy["OMP_NUM_THREADS"] = omp_threads
+            env_copy["MKL_NUM_THREADS"] = str(pal)
+            # Per thread
+            env_copy["OMP_STACKSIZE"] = f"{self.mem}M"
+            self._pal_envs[pal_key] = env_copy
+
+        return self._pal_envs[pal_key]
+
+    def get_energy(self, atoms, coords, via_grad=False, **prepare_kwargs):
+        """Energy from a singlepoint calculation w/o gradient.
+
+        With via_grad=True, a gradient calculation is run and the forces
+        are discarded, as was done before."""
+        if via_grad:
+            results = self.get_forces(atoms, coords, **prepare_kwargs)
+            del results["forces"]
+            return results
+
+        self.prepare_input(atoms, coords, "energy", **prepare_kwargs)
+        inp = self.prepare_coords(atoms, coords)
+        add_args = self.prepare_add_args()
+        self.log(f"Executing {self.base_cmd} {add_args}")
+        kwargs = {
+            "calc": "energy",
+            "add_args": add_args,
+            "env": self.get_pal_env(),
+        }
+        results = self.run(inp, **kwargs)
         return results
 
     def get_forces(self, atoms, coords, **prepare_kwargs):
@@ -235,6 +384,139 @@ class XTB(Calculator):
         results = self.run(inp, **kwargs)
         return results
 
+    async def run_async(self, path, add_args, env, semaphore):
+        """Run xtb in an already prepared directory w/o blocking.
+
+        Returns whether the calculation terminated normally."""
+        async with semaphore:
+            with open(path / self.out_fn, "w") as handle:
+                proc = await asyncio.create_subprocess_exec(
+                    self.base_cmd,
+                    self.inp_fn,
+                    *add_args,
+                    cwd=path,
+                    stdout=handle,
+                    stderr=asyncio.subprocess.PIPE,
+                    env=env,
+                )
+                await proc.communicate()
+        try:
+            return self.check_termination(path / self.out_fn)
+        except FileNotFoundError:
+            return False
+
+    def get_forces_batch(
+        self, atoms_list, coords_list, max_concurrency=None, **prepare_kwargs
+    ):
+        """Calculate forces for several geometries concurrently.
+
+        Every geometry is calculated in its own temporary directory and up to
+        'max_concurrency' xtb processes are run simultaneously. The 'pal' cores
+        are divided among these processes. Results are parsed and kept in the
+        order the geometries were given, as if 'get_forces' was called for every
+        geometry. Calculations that did not terminate normally are repeated
+        serially, if retries are enabled.
+
+        Parameters
+        ----------
+        atoms_list : list of iterables
+            Atom descriptors (element symbols) of every geometry.
+        coords_list : list of np.array, 1d
+            1D-arrays holding the coordinates in Bohr of every geometry.
+        max_concurrency : int, optional
+            Maximum number of simultaneously running xtb processes. Defaults
+            to 'pal', i.e., one single-threaded process per core. Values above
+            'pal' oversubscribe the available cores.
+
+        Returns
+        -------
+        all_results : list of dicts
+            Energy and forces for every geometry.
+        """
+        assert len(atoms_list) == len(coords_list)
+        if max_concurrency is None:
+            max_concurrency = self.pal
+        assert max_concurrency > 0, "max_concurrency must be a positive integer!"
+        if max_concurrency > self.pal:
+            self.log(
+                f"Running up to {max_concurrency} processes on only pal={self.pal} "
+                "cores!"
+            )
+
+        if not shutil.which(self.base_cmd or ""):
+            raise FileNotFoundError(
+                f"Command '{self.base_cmd}' could not be found on $PATH! "
+                "Maybe you forgot to make it available?"
+            )
+
+        add_args = self.prepare_add_args() + ["--grad"]
+        env = self.get_pal_env(pal=max(1, self.pal // max_concurrency))
+        paths = list()
+        inps = list()
+        counters = list()
+        try:
+            for atoms, coords in zip(atoms_list, coords_list):
+                # prepare_input() may already increment the counter on its own,
+                # e.g., when the topology is updated, so the live counter is used.
+                self.prepare_input(atoms, coords, "forces", **prepare_kwargs)
+                inp = self.prepare_coords(atoms, coords)
+                paths.append(self.prepare(inp))
+                inps.append(inp)
+                self.path_already_prepared = None
+                # Reserve a counter for every calculation, so no kept files clash.
+                counters.append(self.calc_counter)
+                self.calc_counter += 1
+            self.log(
+                f"Executing {len(paths)} calculations with up to {max_concurrency} "
+                f"concurrent processes: {self.base_cmd} {add_args}"
+            )
+
+            async def run_all():
+                semaphore = asyncio.Semaphore(max_concurrency)
+                return await asyncio.gather(
+                    *[self.run_async(path, add_args, env, semaphore) for path in paths]
+                )
+
+            normal_terminations = asyncio.run(run_all())
+
+            all_results = list()
+            for i, (atoms, coords, normal_termination) in enumerate(
+                zip(atoms_list, coords_list, normal_terminations)
+            ):
+                path = paths[i]
+                # The directory is taken care of in here; don't clean it again below.
+                paths[i] = None
+                if (not normal_termination) and self.retry_calc > 0:
+                    self.log(f"Detected abnormal termination in '{path}'! Rerunning.")
+                    if self.clean_after:
+                        self.clean(path)
+                    # Runs with the next free counter and increments it
+                    all_results.append(self.get_forces(atoms, coords, **prepare_kwargs))
+                    continue
+                next_counter = self.calc_counter
+                self.calc_counter = counters[i]
+                try:
+                    results = self.parse_gradient(path)
+                    self.keep(path)
+                except Exception as err:
+                    self.backup_crashed(inps[i], path)
+                    raise err
+                finally:
+                    if self.clean_after:
+                        self.clean(path)
+                    self.calc_counter = next_counter
+                all_results.append(results)
+        finally:
+            # Remove directories of calculations that were never parsed
+            leftover = [path for path in paths if path is not None]
+            if self.path_already_prepared is not None:
+                leftover.append(self.path_already_prepared)
+                self.path_already_prepared = None
+            if self.clean_after:
+                for path in leftover:
+                    self.clean(path)
+        return all_results
+
     def get_hessian(self, atoms, coords, **prepare_kwargs):
         self.prepare_input(atoms, coords, "hessian", **prepare_kwargs)
         inp = self.prepare_coords(atoms, coords)
@@ -272,21 +554,19 @@ class XTB(Calculator):
             "topo": target,
         }
 
-    def get_mdrestart_str(self, coords, velocities):
+    @staticmethod
+    def get_mdrestart_str(coords, velocities):
         """coords and velocities have to given in au!"""
         vals = np.concatenate((coords, velocities), axis=1)
 
-        with io.StringIO() as io_stream:
-            np.savetxt(io_stream, vals, fmt="% .14e")
-            mdrestart = io_stream.getvalue()
+        line_fmt = " " + " ".join(["% .14e"] * vals.shape[1]) + "\n"
+        body = (line_fmt * len(vals)) % tuple(vals.flat)
         # What does the -1.0 mean?
-        mdrestart = "-1.0\n" + mdrestart.replace("e", "D")
-        mdrestart = textwrap.indent(mdrestart, " ")
+        mdrestart = " -1.0\n" + body.translate(_E_TO_D)
         return mdrestart
 
     def write_mdrestart(self, path, mdrestart_str):
-        with open(path / "mdrestart", "wb") as handle:
-            handle.write(mdrestart_str.encode("ascii"))
+        write_bytes_atomic(path / "mdrestart", mdrestart_str.encode("ascii"))
 
     def run_md(self, atoms, coords, t, dt, velocities=None, dump=1):
         """Expecting t and dt in fs, even though xtb wants t in ps!"""
@@ -318,9 +598,8 @@ class XTB(Calculator):
 
         options.update(self.xtb_options)
 
-        md_str = self.format_xcontrol(options)
-        with open(path / "xcontrol", "w") as handle:
-            handle.write(md_str)
+        md_str = self.format_xcontrol(options, sort=False)
+        write_bytes_atomic(path / "xcontrol", md_str.encode("utf-8"))
         inp = self.prepare_coords(atoms, coords)
 
         add_args = self.prepare_add_args() + ["--input", "xcontrol", "--md"]
@@ -368,21 +647,41 @@ class XTB(Calculator):
         opt_result = OptResult(opt_geom=opt_geom, opt_log=opt_log)
         return opt_result
 
+    def load_json(self, fn):
+        """Load a xtbout.json file. The last loaded file is cached.
+
+        The returned dict is shared between calls and must not be modified."""
+        stat = os.stat(fn)
+        key = (str(fn), stat.st_mtime_ns, stat.st_size)
+        if key != self._json_cache_key:
+            with open(fn, "r") as handle:
+                self._json_cache = json.load(handle)
+            self._json_cache_key = key
+        return self._json_cache
+
     def parse_energy(self, path):
-        with open(path / self.out_fn) as handle:
-            text = handle.read()
-        energy_re = r"TOTAL ENERGY\s*([-\d\.]+) Eh"
-        energy = float(re.search(energy_re, text)[1])
+        # xtbout.json is only written when requested in the xcontrol file
+        json_fn = path / "xtbout.json"
+        if json_fn.exists():
+            try:
+                return float(self.load_json(json_fn)["total energy"])
+            # Not every dump contains the energy, e.g., for other xtb versions
+            except KeyError:
+                self.log(f"No total energy in '{json_fn}'. Parsing '{self.out_fn}'.")
+
+        # The energy is always printed in the summary at the end of the file
+        energy = float(search_tail(path / self.out_fn, _ENERGY_RE)[1])
         return energy
 
     def parse_gradient(self, path):
         return parse_turbo_gradient(path)
 
     def parse_hessian(self, path):
-        with open(path / "hessian") as handle:
-            text = handle.read()
-        hessian = np.array(text.split()[1:], dtype=float)
-        coord_num = int(hessian.size ** 0.5)
+        with open(path / "hessian", "rb") as handle:
+            # Skip '$hessian' header and parse the remaining floats directly
+            handle.readline()
+            hessian = np.fromfile(handle, sep=" ")
+        coord_num = int(round(hessian.size ** 0.5))
         hessian = hessian.reshape(coord_num, coord_num)
         energy = self.parse_energy(path)
         results = {
@@ -392,24 +691,37 @@ class XTB(Calculator):
         return results
 
     def parse_charges(self, fn=None):
+        """Partial charges as 1d array of shape (natoms, ), even for one atom."""
         if fn is None:
             fn = self.charges
-        charges = np.loadtxt(fn, dtype=float)
+        try:
+            charges = np.fromfile(fn, sep="\n", dtype=float)
+        except ValueError:
+            charges = None
+        # Older numpy versions don't raise on unparsable data, but only warn and
+        # return a truncated array, so the number of values is checked, too.
+        if charges is not None:
+            with open(fn, "rb") as handle:
+                value_num = sum(1 for line in handle if line.strip())
+        if (charges is None) or (charges.size != value_num):
+            charges = np.loadtxt(fn, dtype=float, ndmin=1)
         return charges
 
     def parse_charges_from_json(self, fn=None):
         if fn is None:
             fn = self.json
-        with open(fn, "r") as handle:
-            dump = json.load(handle)
-        charges = dump["partial charges"]
+        dump = self.load_json(fn)
+        # Copy, as the loaded dump is cached
+        charges = list(dump["partial charges"])
         return charges
 
     @staticmethod
-    @file_or_str(".out")
-    def check_termination(text):
-        term_re = re.compile("finished run on")
-        mobj = term_re.search(text)
+    def check_termination(inp):
+        # Only the end of an out-file has to be searched for the marker
+        if Path(inp).suffix == ".out":
+            mobj = search_tail(inp, _TERM_RE, tail_size=2048)
+        else:
+            mobj = _TERM_RE.search(inp.encode())
         return bool(mobj)
 
     def get_retry_args(self):
@@ -417,7 +729,7 @@ class XTB(Calculator):
             return []
 
         self.log(f"Retrying calculation with increased etemp={self.retry_etemp}")
-        return f"--etemp {self.retry_etemp}".split()
+        return ["--etemp", str(self.retry_etemp)]
 
     def __str__(self):
         return "XTB calculator"
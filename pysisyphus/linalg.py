@@ -1,5 +1,5 @@
 from math import cos, sin, sqrt
-from typing import Callable, Literal, Optional, Tuple
+from typing import Callable, List, Literal, Optional, Tuple
 
 import numpy as np
 from numpy.typing import NDArray
@@ -155,12 +155,20 @@ def finite_difference_hessian(
     step_size: float = 1e-2,
     acc: Literal[2, 4] = 2,
     callback: Optional[Callable] = None,
+    batch_grad_func: Optional[
+        Callable[[List[NDArray[float]]], List[NDArray[float]]]
+    ] = None,
 ) -> NDArray[float]:
     """Numerical Hessian from central finite gradient differences.
 
     See central differences in
       https://en.wikipedia.org/wiki/Finite_difference_coefficient
     for the different accuracies.
+
+    When 'batch_grad_func' is given, it is called once with the list of all
+    displaced coordinates and must return the corresponding gradients. This
+    allows calculating the gradients concurrently. 'grad_func' is not used
+    in this case.
     """
     if callback is None:
 
@@ -179,6 +187,23 @@ def finite_difference_hessian(
     zero_step = np.zeros(size)
 
     coeffs = accuracies[acc]
+    if batch_grad_func is not None:
+        all_displ_coords = list()
+        for i, _ in enumerate(coords):
+            step = zero_step.copy()
+            step[i] = step_size
+            for j, (_, displ) in enumerate(coeffs):
+                callback(i, j)
+                all_displ_coords.append(coords + step * displ)
+        all_grads = np.reshape(
+            batch_grad_func(all_displ_coords), (size, len(coeffs), -1)
+        )
+        factors = np.array([factor for factor, _ in coeffs])
+        fd_hessian = np.einsum("j,ijk->ik", factors, all_grads) / step_size
+        # Symmetrize
+        fd_hessian = (fd_hessian + fd_hessian.T) / 2
+        return fd_hessian
+
     for i, _ in enumerate(coords):
         step = zero_step.copy()
         step[i] = step_size
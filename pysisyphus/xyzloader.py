@@ -9,16 +9,20 @@ def make_xyz_str(atoms, coords, comment=""):
     assert len(atoms) == len(coords)
     atoms = [a.capitalize() for a in atoms]
 
-    coord_fmt = "{: 03.8f}"
-    line_fmt = "{:>3s} " + " ".join(
+    coord_fmt = "% 03.8f"
+    line_fmt = "%3s " + " ".join(
         [
             coord_fmt,
         ]
         * 3
     )
 
-    body = [line_fmt.format(a, *xyz) for a, xyz in zip(atoms, coords)]
-    body = "\n".join(body)
+    # Format all lines at once, which is considerably faster for big systems
+    # than formatting every line on its own.
+    values = [
+        val for a, xyz in zip(atoms, np.asarray(coords).tolist()) for val in (a, *xyz)
+    ]
+    body = "\n".join([line_fmt] * len(atoms)) % tuple(values)
 
     return f"{len(atoms)}\n{comment}\n{body}"
 
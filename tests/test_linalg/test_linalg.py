@@ -29,3 +29,20 @@ def test_water_fd_hessian():
     calc = PySCF(basis="321g", pal=2)
     geom.set_calculator(calc)
     assert_hessians(geom)
+
+
+def test_fd_hessian_batch():
+    geom = AnaPot().get_saddles(i=0)
+
+    def grad_func(coords):
+        return -geom.get_energy_and_forces_at(coords)["forces"]
+
+    def batch_grad_func(coords_list):
+        return [grad_func(coords) for coords in coords_list]
+
+    for acc in (2, 4):
+        fd_hessian = finite_difference_hessian(geom.coords, grad_func, acc=acc)
+        batch_fd_hessian = finite_difference_hessian(
+            geom.coords, None, acc=acc, batch_grad_func=batch_grad_func
+        )
+        np.testing.assert_allclose(batch_fd_hessian, fd_hessian)
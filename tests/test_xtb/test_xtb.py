@@ -1,8 +1,17 @@
+import asyncio
+import json
+import os
+from pathlib import Path
+import re
+import shutil
+import tempfile
+
 import numpy as np
 import pytest
 import textwrap
 
 from pysisyphus.calculators import XTB
+from pysisyphus.calculators.XTB import _ENERGY_RE, search_tail
 from pysisyphus.dynamics.helpers import get_mb_velocities_for_geom
 from pysisyphus.helpers import geom_loader
 from pysisyphus.helpers_pure import eigval_to_wavenumber
@@ -123,3 +132,341 @@ def test_xtb_format_xcontrol_two_groups():
     $end
     """).strip()
     assert XTB.format_xcontrol({"write": {"json": True}, "md": {"restart": "true"}}) == expected
+
+
+def test_xtb_format_xcontrol_unsorted():
+    expected = textwrap.dedent("""
+    $write
+        json=true
+    $end
+    $md
+        restart=true
+    $end
+    """).strip()
+    options = {"write": {"json": True}, "md": {"restart": "true"}}
+    assert XTB.format_xcontrol(options, sort=False) == expected
+
+
+def test_xtb_mdrestart_str():
+    coords = np.array(((0.0, 1.0, -2.5),))
+    velocities = np.array(((1e-4, -2e-5, 0.0),))
+    expected = (
+        " -1.0\n"
+        "  0.00000000000000D+00  1.00000000000000D+00 -2.50000000000000D+00"
+        "  1.00000000000000D-04 -2.00000000000000D-05  0.00000000000000D+00\n"
+    )
+    assert XTB.get_mdrestart_str(coords, velocities) == expected
+
+
+def test_xtb_parse_hessian(tmp_path):
+    # xtb writes 5 values per line, so the last line of each row may be shorter
+    H = np.arange(49, dtype=float).reshape(7, 7) / 10.0
+    lines = [" $hessian"]
+    for row in H:
+        for i in range(0, row.size, 5):
+            lines.append("".join(f"{v:15.10f}" for v in row[i : i + 5]))
+    (tmp_path / "hessian").write_text("\n".join(lines) + "\n")
+    (tmp_path / "xtb.out").write_text("| TOTAL ENERGY   -5.070544440569 Eh   |\n")
+
+    calc = XTB(out_dir=tmp_path)
+    results = calc.parse_hessian(tmp_path)
+    assert results["energy"] == pytest.approx(-5.070544440569)
+    np.testing.assert_allclose(results["hessian"], H)
+
+
+@using("xtb")
+def test_xtb_forces_batch(geom):
+    calc = geom.calculator
+    atoms = geom.atoms
+    coords = geom.cart_coords
+    coords_list = [coords, coords + 0.01, coords - 0.01]
+    batch_results = calc.get_forces_batch([atoms] * 3, coords_list, max_concurrency=3)
+    for coords_, results in zip(coords_list, batch_results):
+        ref_results = calc.get_forces(atoms, coords_)
+        assert results["energy"] == pytest.approx(ref_results["energy"])
+        np.testing.assert_allclose(results["forces"], ref_results["forces"])
+
+
+def test_xtb_parse_charges_file(tmp_path):
+    charges_fn = tmp_path / "charges"
+    charges_fn.write_text("   1.55773\n  -0.77886\n  -0.77887\n")
+    calc = XTB(out_dir=tmp_path)
+    charges = calc.parse_charges(charges_fn)
+    np.testing.assert_allclose(charges, (1.55773, -0.77886, -0.77887))
+
+    # 1d array, even for only one atom
+    charges_fn.write_text("   0.00000\n")
+    charges = calc.parse_charges(charges_fn)
+    assert charges.shape == (1,)
+
+
+@pytest.mark.parametrize("batch", (False, True))
+def test_xtb_num_hessian_batch(batch, tmp_path, monkeypatch):
+    calc = XTB(out_dir=tmp_path, num_hess_kwargs={"batch": batch})
+    batch_sizes = list()
+
+    # Quadratic model potential with unit Hessian
+    def get_forces(atoms, coords, **kwargs):
+        return {"energy": 0.5 * coords.dot(coords), "forces": -coords}
+
+    def get_forces_batch(atoms_list, coords_list, **kwargs):
+        batch_sizes.append(len(coords_list))
+        return [
+            get_forces(atoms, coords) for atoms, coords in zip(atoms_list, coords_list)
+        ]
+
+    monkeypatch.setattr(calc, "get_energy", get_forces)
+    monkeypatch.setattr(calc, "get_forces", get_forces)
+    monkeypatch.setattr(calc, "get_forces_batch", get_forces_batch)
+    atoms = ("O", "H", "H")
+    coords = np.arange(9, dtype=float)
+
+    hessian = calc.get_num_hessian(atoms, coords)["hessian"]
+    np.testing.assert_allclose(hessian, np.eye(9), atol=1e-10)
+    assert batch_sizes == ([18] if batch else [])
+
+    # Concurrent calculations are not possible inside a running event loop
+    async def main():
+        return calc.get_num_hessian(atoms, coords)["hessian"]
+
+    hessian = asyncio.run(main())
+    np.testing.assert_allclose(hessian, np.eye(9), atol=1e-10)
+    assert batch_sizes == ([18] if batch else [])
+
+
+def test_xtb_forces_batch_cleanup(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    base_name = "batch_cleanup"
+    calc = XTB(out_dir=tmp_path, base_name=base_name)
+    calc.base_cmd = "xtb"
+    monkeypatch.setattr(shutil, "which", lambda cmd: cmd)
+
+    async def run_async(path, add_args, env, semaphore):
+        return True
+
+    parsed = list()
+
+    def parse_gradient(path):
+        parsed.append(path)
+        if len(parsed) == 2:
+            raise ValueError("Parsing failed!")
+        return {"energy": 0.0, "forces": np.zeros(9)}
+
+    monkeypatch.setattr(calc, "run_async", run_async)
+    monkeypatch.setattr(calc, "parse_gradient", parse_gradient)
+
+    def leftover_dirs():
+        return list(Path(tempfile.gettempdir()).glob(f"{base_name}_*"))
+
+    atoms = ("O", "H", "H")
+    coords = np.zeros(9)
+    with pytest.raises(ValueError):
+        calc.get_forces_batch([atoms] * 4, [coords] * 4)
+    # Counters of all prepared calculations are used up
+    assert calc.calc_counter == 4
+    assert (tmp_path / f"crashed_{calc.name}").exists()
+    assert not leftover_dirs()
+
+    results = calc.get_forces_batch([atoms] * 3, [coords] * 3)
+    assert len(results) == 3
+    assert calc.calc_counter == 7
+    assert not leftover_dirs()
+
+
+def test_xtb_forces_batch_missing_cmd(tmp_path):
+    calc = XTB(out_dir=tmp_path)
+    calc.base_cmd = "xtb_that_does_not_exist"
+    with pytest.raises(FileNotFoundError):
+        calc.get_forces_batch([("H", "H")], [np.zeros(6)])
+    assert calc.calc_counter == 0
+
+
+def test_xtb_forces_batch_topo_update(tmp_path, monkeypatch):
+    topo = tmp_path / "gfnff_topo"
+    topo.write_text("topology")
+    calc = XTB(out_dir=tmp_path, topo=topo, topo_update=2)
+    calc.base_cmd = "xtb"
+    monkeypatch.setattr(shutil, "which", lambda cmd: cmd)
+
+    topo_counters = list()
+
+    # The topology update runs a calculation on its own, using up a counter
+    def run_topo(atoms, coords):
+        topo_counters.append(calc.calc_counter)
+        calc.calc_counter += 1
+        return {"topo": topo}
+
+    async def run_async(path, add_args, env, semaphore):
+        return True
+
+    parse_counters = list()
+
+    def parse_gradient(path):
+        parse_counters.append(calc.calc_counter)
+        return {"energy": 0.0, "forces": np.zeros(9)}
+
+    monkeypatch.setattr(calc, "run_topo", run_topo)
+    monkeypatch.setattr(calc, "run_async", run_async)
+    monkeypatch.setattr(calc, "parse_gradient", parse_gradient)
+
+    atoms = ("O", "H", "H")
+    results = calc.get_forces_batch([atoms] * 5, [np.zeros(9)] * 5)
+    assert len(results) == 5
+    # Topology updates before the 3rd and 5th calculation
+    assert topo_counters == [2, 5]
+    assert parse_counters == [0, 1, 3, 4, 6]
+    assert calc.calc_counter == 7
+    assert sorted(calc.kept_history.keys()) == parse_counters
+
+
+@pytest.mark.parametrize("link_staged", (True, False))
+def test_xtb_link_topo_staging(link_staged, tmp_path, monkeypatch):
+    topo = tmp_path / "gfnff_topo"
+    topo.write_text("topology")
+    calc = XTB(out_dir=tmp_path, topo=topo)
+
+    org_link = os.link
+
+    def link(src, dst):
+        # Simulate a topology on a different filesystem than the scratch directories
+        # or, when link_staged is False, a filesystem w/o hardlink support.
+        if (Path(src).parent == tmp_path) or not link_staged:
+            raise OSError("Linking not possible!")
+        org_link(src, dst)
+
+    copies = list()
+    org_copy = shutil.copy
+
+    def copy(src, dst):
+        copies.append(src)
+        return org_copy(src, dst)
+
+    monkeypatch.setattr(os, "link", link)
+    monkeypatch.setattr(shutil, "copy", copy)
+
+    paths = list()
+    for _ in range(3):
+        path = calc.prepare_path()
+        calc.link_topo(path)
+        paths.append(path)
+    staging_dir = calc._topo_staging_dir
+    staged_topo = staging_dir / "gfnff_topo"
+    # Only one copy from the original topology
+    assert copies.count(topo) == 1
+    assert copies.count(staged_topo) == (0 if link_staged else 3)
+    for path in paths:
+        assert (path / "gfnff_topo").read_text() == "topology"
+
+    # A modified topology is staged again, reusing the staging directory
+    topo.write_text("updated topology")
+    path = calc.prepare_path()
+    calc.link_topo(path)
+    paths.append(path)
+    assert copies.count(topo) == 2
+    assert calc._topo_staging_dir == staging_dir
+    assert (path / "gfnff_topo").read_text() == "updated topology"
+    assert (paths[0] / "gfnff_topo").read_text() == "topology"
+
+    for path in paths:
+        shutil.rmtree(path)
+
+
+def test_xtb_parse_energy_outside_tail(tmp_path):
+    # The energy is only found by falling back to reading the whole file
+    out_text = "| TOTAL ENERGY   -5.070544440569 Eh   |\n" + "x" * 10_000 + "\n"
+    (tmp_path / "xtb.out").write_text(out_text)
+    calc = XTB(out_dir=tmp_path)
+    assert calc.parse_energy(tmp_path) == pytest.approx(-5.070544440569)
+
+
+def test_xtb_search_tail_last_match(tmp_path):
+    out_fn = tmp_path / "xtb.out"
+    out_fn.write_text(
+        "| TOTAL ENERGY   -1.0 Eh   |\n"
+        + "x" * 10_000
+        + "\n| TOTAL ENERGY   -2.0 Eh   |\n| TOTAL ENERGY   -3.0 Eh   |\n"
+    )
+    mobj = search_tail(out_fn, _ENERGY_RE)
+    assert float(mobj[1]) == pytest.approx(-3.0)
+    assert search_tail(out_fn, re.compile(b"not present")) is None
+
+
+def test_xtb_termination_text(this_dir):
+    text = (this_dir / "xtb_pass.out").read_text()
+    assert XTB.check_termination(text)
+    assert not XTB.check_termination("abnormal termination of xtb")
+
+
+def test_xtb_termination_outside_tail(tmp_path):
+    out_fn = tmp_path / "xtb.out"
+    out_fn.write_text(" * finished run on 2021/10/06\n" + "x" * 10_000 + "\n")
+    assert XTB.check_termination(out_fn)
+    assert XTB.check_termination(str(out_fn))
+
+
+def test_xtb_termination_missing_file(tmp_path):
+    # Calculator.run() relies on the FileNotFoundError
+    with pytest.raises(FileNotFoundError):
+        XTB.check_termination(tmp_path / "xtb.out")
+
+
+def test_xtb_parse_energy_json(tmp_path):
+    (tmp_path / "xtb.out").write_text("| TOTAL ENERGY   -5.070544440569 Eh   |\n")
+    calc = XTB(out_dir=tmp_path)
+    # Fallback to xtb.out
+    assert calc.parse_energy(tmp_path) == pytest.approx(-5.070544440569)
+
+    json_fn = tmp_path / "xtbout.json"
+    dump = {"total energy": -5.070544440569123, "partial charges": [0.5, -0.5]}
+    json_fn.write_text(json.dumps(dump))
+    assert calc.parse_energy(tmp_path) == -5.070544440569123
+
+    # Fallback to xtb.out, when the dump lacks the energy
+    json_fn.write_text(json.dumps({"partial charges": [0.5, -0.5]}))
+    assert calc.parse_energy(tmp_path) == pytest.approx(-5.070544440569)
+
+    # Modifying the returned charges must not change the cached dump
+    charges = calc.parse_charges_from_json(json_fn)
+    charges[0] = 100.0
+    assert calc.parse_charges_from_json(json_fn) == [0.5, -0.5]
+
+
+def test_xtb_get_energy_wo_grad(tmp_path, monkeypatch):
+    calc = XTB(out_dir=tmp_path)
+    run_kwargs = list()
+
+    def run(inp, **kwargs):
+        run_kwargs.append(kwargs)
+        shutil.rmtree(calc.path_already_prepared)
+        calc.path_already_prepared = None
+        return {"energy": 0.0, "forces": np.zeros(6)}
+
+    monkeypatch.setattr(calc, "run", run)
+    atoms = ("H", "H")
+    coords = np.array((0.0, 0.0, 0.0, 0.0, 0.0, 1.4))
+
+    calc.get_energy(atoms, coords)
+    assert run_kwargs[-1]["calc"] == "energy"
+    assert "--grad" not in run_kwargs[-1]["add_args"]
+
+    results = calc.get_energy(atoms, coords, via_grad=True)
+    assert run_kwargs[-1]["calc"] == "grad"
+    assert "--grad" in run_kwargs[-1]["add_args"]
+    assert "forces" not in results
+
+    (tmp_path / "xtb.out").write_text("| TOTAL ENERGY   -1.137 Eh   |\n")
+    assert calc.parser_funcs["energy"](tmp_path) == {"energy": pytest.approx(-1.137)}
+
+
+def test_xtb_parse_charges_truncated(tmp_path, monkeypatch):
+    charges_fn = tmp_path / "charges"
+    charges_fn.write_text("   1.55773\n  -0.77886\n  -0.77887\n")
+    calc = XTB(out_dir=tmp_path)
+
+    # Mimic older numpy versions, that return truncated arrays w/o raising
+    def fromfile(fn, sep, dtype):
+        return np.array((1.55773,))
+
+    monkeypatch.setattr(np, "fromfile", fromfile)
+    charges = calc.parse_charges(charges_fn)
+    np.testing.assert_allclose(charges, (1.55773, -0.77886, -0.77887))